@@ -8,6 +8,7 @@ https://stackoverflow.com/questions/21566379/fitting-a-2d-gaussian-function-usin
 """
 import os
 import sys
+import concurrent.futures
 
 from statistics import variance
 import numpy as np
@@ -172,11 +173,7 @@ def gaussian_fit(image, initial_guess=None, plot=True, show=False, cmap=plt.cm.j
 
     # Plot the original image with the fitted curves.
     if plot:
-        image_fitted = twoD_Gaussian((x, y), *param_estimate)
-        # fig, ax = plt.subplots(1, 1)
-        plt.imshow(image, cmap=cmap)
-        # plt.colorbar()
-        plt.contour(x, y, image_fitted.reshape(y_size, x_size), 9, colors='w')
+        plot_gaussian_fit(image, param_estimate, cmap=cmap)
 
     if show:
         plt.show()
@@ -184,6 +181,63 @@ def gaussian_fit(image, initial_guess=None, plot=True, show=False, cmap=plt.cm.j
     return param_estimate, param_sem
 
 
+def plot_gaussian_fit(image, param_estimate, cmap=plt.cm.jet):
+    """
+    Plots the image with the isoclines of its 2D Gaussian fit. Useful when the
+    fit has already been done, e.g., by gaussian_fit_batch().
+    """
+    y_size, x_size = image.shape
+    x, y = np.meshgrid(np.arange(x_size), np.arange(y_size))
+    image_fitted = twoD_Gaussian((x, y), *param_estimate)
+    # fig, ax = plt.subplots(1, 1)
+    plt.imshow(image, cmap=cmap)
+    # plt.colorbar()
+    plt.contour(x, y, image_fitted.reshape(y_size, x_size), 9, colors='w')
+
+
+def _gaussian_fit_no_plot(image, initial_guess):
+    return gaussian_fit(image, initial_guess=initial_guess, plot=False)
+
+
+def gaussian_fit_batch(images, initial_guesses=None, max_workers=None,
+                       executor=None):
+    """
+    Fits a 2D gaussian to each of the input images. The fits are independent
+    of each other, so they are distributed across processes.
+
+    Parameters
+    ----------
+    images: 3D numpy array or list of 2D numpy arrays
+        The images to be fit, e.g., the maps of all units of a layer.
+    initial_guesses: list of tuples or None
+        Initial guesses for the parameters of each image. An item can be None
+        to use the default guess of gaussian_fit().
+    max_workers: int or None
+        The number of processes. Uses all processors if None. Ignored if
+        executor is given.
+    executor: concurrent.futures.Executor or None
+        An existing pool to run the fits in. Pass one when calling this
+        function repeatedly, so the processes are only started once. A new
+        pool is created (and shut down) for this call if None.
+
+    Returns
+    -------
+    param_estimates & param_sems: 2D numpy arrays
+        The outputs of gaussian_fit() stacked into arrays with the dimension:
+        [num_images, GaussianFitParamFormat.NUM_PARAMS].
+    """
+    if initial_guesses is None:
+        initial_guesses = [None] * len(images)
+    if executor is None:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as executor:
+            return gaussian_fit_batch(images, initial_guesses, executor=executor)
+    results = list(executor.map(_gaussian_fit_no_plot, images, initial_guesses,
+                                chunksize=max(1, len(images)//64)))
+    param_estimates = np.array([params for params, _ in results])
+    param_sems = np.array([sems for _, sems in results])
+    return param_estimates, param_sems
+
+
 def test_gaussian_fit():
     """Test fit a 2D Gaussian."""
     # Create x and y indices.
@@ -457,6 +511,15 @@ def theta_to_ori(sigma_1, sigma_2, theta):
     return wrap_angle_180(theta - 90)
 
 
+def theta_to_ori_vec(sigma_1, sigma_2, theta):
+    """
+    Same as theta_to_ori(), but takes numpy arrays of the parameters of many
+    fits and returns an array of orientations (0 <= orientation < 180).
+    """
+    theta = np.where(sigma_1 > sigma_2, theta, theta - 90)
+    return np.mod(theta, 180)
+
+
 #######################################.#######################################
 #                                                                             #
 #                                PARAM CLEANER                                #
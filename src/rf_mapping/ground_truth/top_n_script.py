@@ -129,6 +129,20 @@ class ConvMaxMinInspector(HookFunctionBase):
         return copy_max_activations, copy_min_activations, copy_max_indices, copy_min_indices
 
 
+def top_n_image_order(responses, n):
+    """
+    Returns the image indices of the n largest responses of every unit, in
+    descending order. responses has the dimension [num_images, num_units].
+    Only the n candidates are fully sorted, so this is much cheaper than
+    argsorting all the images of every unit. n is clamped to num_images.
+    """
+    n = min(n, len(responses))
+    top_img_index = np.argpartition(-responses, n-1, axis=0)[:n]
+    top_responses = np.take_along_axis(responses, top_img_index, axis=0)
+    order = np.flip(top_responses.argsort(axis=0), axis=0)  # Make it descending
+    return np.take_along_axis(top_img_index, order, axis=0)  # [n, num_units]
+
+
 # Initiate helper objects.
 inspector = ConvMaxMinInspector(model)
 
@@ -197,21 +211,21 @@ all_sorted_top_n_img_indices = []
 all_unsorted_responses = []
 for layer_i in tqdm(range(num_layers)):
     num_units =  all_img_indicies[layer_i].shape[1]
-    top_n_img_idx = np.zeros((num_units, top_n, 4), dtype=int)
-    unsorted_responses = np.zeros((num_units, num_images, 2))
-    for unit_i in range(num_units):
-        # Top N patches:
-        sorted_img_index = all_responses[layer_i][:,unit_i,0].argsort()
-        sorted_img_index = np.flip(sorted_img_index)  # Make it descending
-        top_n_img_idx[unit_i, :, 0] = all_img_indicies[layer_i][:,unit_i,0][sorted_img_index][:top_n]
-        top_n_img_idx[unit_i, :, 1] = all_img_indicies[layer_i][:,unit_i,1][sorted_img_index][:top_n]
-        unsorted_responses[unit_i, :, 0] = all_responses[layer_i][:,unit_i,0]
-        
-        # Bottom N patches:
-        sorted_img_index = all_responses[layer_i][:,unit_i,1].argsort()
-        top_n_img_idx[unit_i, :, 2] = all_img_indicies[layer_i][:,unit_i,0][sorted_img_index][:top_n]
-        top_n_img_idx[unit_i, :, 3] = all_img_indicies[layer_i][:,unit_i,2][sorted_img_index][:top_n]
-        unsorted_responses[unit_i, :, 1] = all_responses[layer_i][:,unit_i,1]
+    num_top = min(top_n, num_images)  # Small test runs may have fewer images.
+    top_n_img_idx = np.zeros((num_units, num_top, 4), dtype=int)
+
+    # Top N patches:
+    sorted_img_index = top_n_image_order(all_responses[layer_i][:,:,0], num_top)
+    top_n_img_idx[:, :, 0] = np.take_along_axis(all_img_indicies[layer_i][:,:,0], sorted_img_index, axis=0).T
+    top_n_img_idx[:, :, 1] = np.take_along_axis(all_img_indicies[layer_i][:,:,1], sorted_img_index, axis=0).T
+
+    # Bottom N patches:
+    sorted_img_index = top_n_image_order(-all_responses[layer_i][:,:,1], num_top)
+    top_n_img_idx[:, :, 2] = np.take_along_axis(all_img_indicies[layer_i][:,:,0], sorted_img_index, axis=0).T
+    top_n_img_idx[:, :, 3] = np.take_along_axis(all_img_indicies[layer_i][:,:,2], sorted_img_index, axis=0).T
+
+    # [num_units, num_images, 2]
+    unsorted_responses = np.ascontiguousarray(all_responses[layer_i].transpose(1, 0, 2))
 
     all_sorted_top_n_img_indices.append(top_n_img_idx)
     all_unsorted_responses.append(unsorted_responses)
@@ -5,6 +5,7 @@ Tony Fu, Jun 22, 2022
 """
 import sys
 import copy
+import warnings
 
 import numpy as np
 import torch
@@ -66,37 +67,171 @@ class HookFunctionBase:
 #                             LAYER OUPUT INSPECTOR                           #
 #                                                                             #
 ###############################################################################
+class _StopForward(Exception):
+    """Raised by a hook function to skip the rest of the forward pass."""
+    pass
+
+
 class LayerOutputInspector(HookFunctionBase):
     """
     A class that peeks inside the outputs of all the layers with the
-    specified layer type, one image at a time.
+    specified layer type, one batch of images at a time.
     """
-    def __init__(self, model, layer_types=(nn.Conv2d)):
+    def __init__(self, model, layer_types=(nn.Conv2d), layer_indices=None,
+                 compile_model=False):
+        """
+        Constructs a LayerOutputInspector object.
+
+        Parameters
+        ----------
+        model : torchvision.models
+            The neural network.
+        layer_types : tuple of torch.nn.Modules
+            The types of the layers to inspect.
+        layer_indices : list of ints, optional
+            The indices of the layers to inspect, counting only the layers of
+            the types <layer_types>. For example, layer_indices = [2] means
+            Conv3 if layer_types = nn.Conv2d. All layers are inspected if None.
+            Otherwise, the forward pass stops after the last of these layers.
+        compile_model : bool
+            Whether to compile the model with torch.compile() (PyTorch 2.1+).
+            Compiling takes a while, so it only pays off when many batches
+            are inspected.
+        """
         super().__init__(model, layer_types)
+        # The channels-last (NHWC) memory format lets cuDNN use its faster
+        # convolution kernels.
+        self.model = self.model.to(c.DEVICE,
+                                   memory_format=torch.channels_last).eval()
+        # The inspector never backpropagates, so there is no need to track the
+        # gradients of the (copied) parameters.
+        self.model.requires_grad_(False)
+        self.layer_indices = None if layer_indices is None else set(layer_indices)
         self.layer_outputs = []
+        self._num_matched_layers = 0
+        self._num_hooked_layers = 0
+        self._num_hooks_called = 0
+
+        self._compile_model = compile_model and hasattr(torch, 'compiler')
+        if compile_model and not self._compile_model:
+            warnings.warn("torch.compile() requires PyTorch 2.1 or newer. "
+                          "The model will not be compiled.")
+        # The hooks have side effects (and may stop the forward pass), so
+        # they are kept out of the compiled graphs. Only the layers between
+        # the hooks are compiled.
+        if self._compile_model:
+            self._hook = torch.compiler.disable(self.hook_function)
+        else:
+            self._hook = self.hook_function
         self.register_forward_hook_to_layers(self.model)
+        # Catches empty, negative, and out-of-range indices, which would
+        # otherwise silently inspect nothing.
+        if (self.layer_indices is not None and
+                (len(self.layer_indices) == 0 or
+                 self._num_hooked_layers != len(self.layer_indices))):
+            raise ValueError(f"layer_indices {sorted(self.layer_indices)} must be "
+                             f"a non-empty list of indices in [0, "
+                             f"{self._num_matched_layers}) for the layers of "
+                             f"the types {self.layer_types}.")
+        if self._compile_model:
+            # The default mode rather than 'reduce-overhead', because the
+            # CUDA graphs of the latter reuse their output buffers. Shapes
+            # only change for the last batch, so they are kept static.
+            self.model = torch.compile(self.model, dynamic=False)
+
+    def register_forward_hook_to_layers(self, layer):
+        # Same as HookFunctionBase's, but only registers the hook to the layers
+        # in self.layer_indices.
+        if (len(list(layer.children())) == 0):
+            if (isinstance(layer, self.layer_types)):
+                if (self.layer_indices is None or
+                        self._num_matched_layers in self.layer_indices):
+                    layer.register_forward_hook(self._hook)
+                    self._num_hooked_layers += 1
+                self._num_matched_layers += 1
+        else:
+            for sublayer in layer.children():
+                self.register_forward_hook_to_layers(sublayer)
 
     def hook_function(self, module, ten_in, ten_out):
-        self.layer_outputs.append(ten_out.clone().detach())
+        # Must copy because the output may be modified in-place afterward
+        # (e.g., by nn.ReLU(inplace=True)). On the GPU, storing the copy in
+        # bfloat16 halves the memory used by the activation volumes. On the
+        # CPU, the outputs are computed in float32 and are kept that way.
+        output_dtype = torch.bfloat16 if c.DEVICE.type == 'cuda' else ten_out.dtype
+        self.layer_outputs.append(ten_out.detach().to(output_dtype, copy=True))
+        self._stop_if_done()
+
+    def _stop_if_done(self):
+        """
+        Must be called at the end of hook_function(). Stops the forward pass
+        once all the requested layers have been inspected, so the deeper
+        layers are not computed for nothing.
+        """
+        self._num_hooks_called += 1
+        if (self.layer_indices is not None and
+                self._num_hooks_called >= self._num_hooked_layers):
+            raise _StopForward
 
-    def inspect(self, image):
+    def _preprocess(self, images):
         """
-        Given an image, returns the output activation volumes of all the layers
-        of the type <layer_type>.
+        Converts an image or a stack of images into a float tensor of shape
+        [batch_size, 3, 2xx, 2xx] on c.DEVICE. Unlike calling
+        preprocess_img_to_tensor() on every image, the whole batch is
+        converted in one go. Batches must already be in CHW format.
+        """
+        if isinstance(images, np.ndarray):
+            if images.ndim < 4:
+                # A single image, possibly in (height, width, 3) format.
+                images = preprocess_img_to_tensor(images)
+            else:
+                images = torch.from_numpy(np.ascontiguousarray(images))
+        # Upload before casting so that fewer bytes are copied for float16
+        # (e.g., packed) or uint8 images.
+        is_uint8 = (images.dtype == torch.uint8)
+        images = images.to(c.DEVICE).float()
+        if is_uint8:
+            images = images / 255  # Same scaling as preprocess_img_to_tensor().
+        if images.dim() == 3:
+            images = images.unsqueeze(0)
+        return images.contiguous(memory_format=torch.channels_last)
+
+    def inspect(self, images):
+        """
+        Given an image or a batch of images, returns the output activation
+        volumes of all the layers of the type <layer_type>.
 
         Parameters
         ----------
-        image : numpy.array or torch.tensor
-            Input image, most likely with the dimension: [3, 2xx, 2xx].
+        images : numpy.array or torch.tensor
+            Input image(s), most likely with the dimension: [3, 2xx, 2xx] or
+            [batch_size, 3, 2xx, 2xx]. A single image may also be in
+            (height, width, 3) format, but batches must be in CHW format
+            because they are not transposed.
 
         Returns
         -------
         layer_outputs : list of torch.tensors
-            Each item is an output activation volume of a target layer.
+            Each item is an output activation volume of a target layer, with
+            the dimension: [batch_size, num_units, yn, xn]. On the GPU, the
+            volumes are stored in bfloat16, which is precise enough to rank
+            activations. Call .float() before converting them to numpy arrays.
         """
-        if (isinstance(image, np.ndarray)):
-            image = preprocess_img_to_tensor(image)
-        _ = self.model(image)
+        self.layer_outputs = []
+        self._num_hooks_called = 0
+        images = self._preprocess(images)
+        # Half precision is only used on the GPU, where the tensor cores
+        # make it worthwhile. bfloat16 is preferred over float16 because it
+        # has the same range as float32, so large activations do not overflow.
+        # device_type is fixed to 'cuda' because older versions of PyTorch
+        # reject other device types (e.g., 'mps') even when disabled.
+        with torch.inference_mode(),\
+             torch.autocast(device_type='cuda', dtype=torch.bfloat16,
+                            enabled=(c.DEVICE.type == 'cuda')):
+            try:
+                _ = self.model(images)
+            except _StopForward:
+                pass
         return self.layer_outputs
 
 
@@ -206,20 +341,200 @@ class ConvMaxInspector(HookFunctionBase):
         return copy_activations, copy_indices
 
 
-def top_bottom_N_image_patches(model, layer_type, image_dir, image_names):
+#######################################.#######################################
+#                                                                             #
+#                            TOP BOTTOM N INSPECTOR                           #
+#                                                                             #
+###############################################################################
+def _merge_top_n(vals, indices, new_vals, new_indices, N, largest):
+    """
+    Merges a running top (or bottom) N with newly observed candidates using
+    torch.topk(). vals has the dimension [n, num_units] and indices has the
+    dimension [n, num_units, 2], where n <= N.
+    """
+    if vals is not None:
+        new_vals = torch.cat((vals, new_vals), dim=0)
+        new_indices = torch.cat((indices, new_indices), dim=0)
+    k = min(N, new_vals.shape[0])
+    vals, order = new_vals.topk(k, dim=0, largest=largest)
+    indices = torch.gather(new_indices, 0, order.unsqueeze(2).expand(-1, -1, 2))
+    return vals, indices
+
+
+class TopBottomNInspector(LayerOutputInspector):
+    """
+    A class that keeps track of the N images that drive each unit the most
+    and the least. Unlike LayerOutputInspector, the activation volumes are
+    reduced inside the hook function, so only the running top and bottom N
+    of each layer are ever stored.
+    """
+    def __init__(self, model, layer_types=(nn.Conv2d), N=100, layer_indices=None,
+                 compile_model=False):
+        super().__init__(model, layer_types, layer_indices, compile_model)
+        self.N = N
+        self.top_n = {}  # layer -> (top_vals, top_idx, bot_vals, bot_idx)
+        self._num_images_seen = 0
+
+    def hook_function(self, module, ten_in, ten_out):
+        # No copy is needed because the volume is reduced right away, before
+        # any in-place operation can modify it.
+        flat_output = ten_out.detach().flatten(2)  # [batch, unit, yn * xn]
+        max_vals, max_locs = flat_output.max(dim=2)
+        min_vals, min_locs = flat_output.min(dim=2)
+        img_indices = torch.arange(self._num_images_seen,
+                                   self._num_images_seen + ten_out.shape[0],
+                                   device=ten_out.device)
+        img_indices = img_indices.unsqueeze(1).expand_as(max_locs)
+        self._update_running_top_n(module,
+                                   max_vals.float(),
+                                   torch.stack((img_indices, max_locs), dim=2),
+                                   min_vals.float(),
+                                   torch.stack((img_indices, min_locs), dim=2))
+        self._stop_if_done()
+
+    def _update_running_top_n(self, module, max_vals, max_idx, min_vals, min_idx):
+        top_vals, top_idx, bot_vals, bot_idx = self.top_n.get(module,
+                                                    (None, None, None, None))
+        top_vals, top_idx = _merge_top_n(top_vals, top_idx, max_vals, max_idx,
+                                         self.N, largest=True)
+        bot_vals, bot_idx = _merge_top_n(bot_vals, bot_idx, min_vals, min_idx,
+                                         self.N, largest=False)
+        self.top_n[module] = (top_vals, top_idx, bot_vals, bot_idx)
+
+    def inspect(self, images):
+        """
+        Presents a batch of images to the model and updates the running top
+        and bottom N. The images are numbered in the order they are presented.
+        """
+        images = self._preprocess(images)
+        super().inspect(images)
+        self._num_images_seen += images.shape[0]
+
+    def get_top_bottom_N(self):
+        """
+        Returns
+        -------
+        top_responses & bottom_responses : list of numpy.arrays
+            One array per layer, with the dimension: [num_units, N]. Sorted in
+            descending (top) or ascending (bottom) order.
+        top_indices & bottom_indices : list of numpy.arrays
+            One array per layer, with the dimension: [num_units, N, 2]. The
+            two columns are the image number and the flattened spatial index
+            of the max (or min) activation in the map.
+        """
+        # Transpose from [N, num_units] to [num_units, N].
+        top_n = self.top_n.values()
+        top_responses = [vals.T.cpu().numpy() for vals, _, _, _ in top_n]
+        top_indices = [idx.transpose(0, 1).cpu().numpy() for _, idx, _, _ in top_n]
+        bottom_responses = [vals.T.cpu().numpy() for _, _, vals, _ in top_n]
+        bottom_indices = [idx.transpose(0, 1).cpu().numpy() for _, _, _, idx in top_n]
+        return top_responses, top_indices, bottom_responses, bottom_indices
+
+
+def _iter_packed_image_batches(packed_images, batch_size):
+    """
+    Yields batches of images from a memory-mapped array of packed images (see
+    image.pack_images()) as tensors on c.DEVICE. On the GPU, the batches are
+    copied from the memmap into two alternating pinned buffers so that the
+    host-to-device copy of one batch can overlap with the computation on the
+    previous one.
+    """
+    num_images = packed_images.shape[0]
+    if c.DEVICE.type != 'cuda':
+        for batch_i in range(0, num_images, batch_size):
+            yield torch.from_numpy(np.array(packed_images[batch_i:batch_i + batch_size]))
+        return
+
+    buffers = [torch.from_numpy(np.empty((batch_size, *packed_images.shape[1:]),
+                                         dtype=packed_images.dtype)).pin_memory()
+               for _ in range(2)]
+    copy_events = [None, None]
+    for buffer_i, batch_i in enumerate(range(0, num_images, batch_size)):
+        buffer_i %= 2
+        # Wait until the previous copy out of this buffer has finished.
+        if copy_events[buffer_i] is not None:
+            copy_events[buffer_i].synchronize()
+        real_batch_size = min(batch_size, num_images - batch_i)
+        buffer = buffers[buffer_i][:real_batch_size]
+        buffer.numpy()[...] = packed_images[batch_i:batch_i + real_batch_size]
+        images = buffer.to(c.DEVICE, non_blocking=True)
+        copy_events[buffer_i] = torch.cuda.Event()
+        copy_events[buffer_i].record()
+        yield images
+
+
+def top_bottom_N_image_patches(model, layer_type, image_dir, image_names,
+                               N=100, batch_size=64, packed_path=None,
+                               layer_indices=None, compile_model=False):
+    """
+    Finds the N images that drive each unit the most and the least. The
+    response of a unit to an image is the max (or min) of its activation map.
+
+    Parameters
+    ----------
+    model : torchvision.models
+        The neural network.
+    layer_type : torch.nn.Module
+        The type of the layers to inspect, e.g., nn.Conv2d.
+    image_dir : str
+        The directory of the .npy image files.
+    image_names : [str, ...]
+        The names of the image files.
+    N : int
+        The number of top and bottom images to keep for each unit.
+    batch_size : int
+        The number of images presented in each forward pass.
+    packed_path : str, optional
+        The path of the images packed by image.pack_images(), in the same
+        order as image_names. If given, the images are streamed from this
+        file instead of being loaded from image_dir one at a time.
+    layer_indices : list of ints, optional
+        The indices of the layers (of type <layer_type>) to rank. All layers
+        are ranked if None.
+    compile_model : bool
+        Whether to compile the model with torch.compile(). Worth it when
+        there are many images.
+
+    Returns
+    -------
+    See TopBottomNInspector.get_top_bottom_N(). The image numbers are the
+    indices of the images in image_names.
+    """
     model.eval()
-    inspector = LayerOutputInspector(model, layer_type)
-    image = np.load(f"{image_dir}/{image_names[0]}")
-    layer_outputs = inspector.inspect(image)
-    for layer_output in layer_outputs: 
-        print(layer_output.max())
+    inspector = TopBottomNInspector(model, layer_type, N, layer_indices,
+                                    compile_model)
+
+    # All batches (but the last) have the same shape, so let cuDNN benchmark
+    # the convolution algorithms once and reuse the fastest ones.
+    cudnn_benchmark = torch.backends.cudnn.benchmark
+    torch.backends.cudnn.benchmark = True
+    try:
+        if packed_path is not None:
+            packed_images = np.load(packed_path, mmap_mode='r')[:len(image_names)]
+            for images in _iter_packed_image_batches(packed_images, batch_size):
+                inspector.inspect(images)
+            return inspector.get_top_bottom_N()
+
+        for batch_i in range(0, len(image_names), batch_size):
+            # Present the images in batches to amortize the overhead of each
+            # forward pass.
+            batch_names = image_names[batch_i:batch_i + batch_size]
+            images = np.stack([np.load(f"{image_dir}/{image_name}")
+                               for image_name in batch_names])
+            inspector.inspect(images)
+        return inspector.get_top_bottom_N()
+    finally:
+        torch.backends.cudnn.benchmark = cudnn_benchmark
 
 
 if __name__ == '__main__':
     model = models.alexnet(pretrained=True)
     image_dir = c.REPO_DIR + "/data/imagenet"
-    image_names = ["0.npy"]
-    top_bottom_N_image_patches(model, nn.Conv2d, image_dir, image_names)
+    image_names = [f"{i}.npy" for i in range(100)]
+    top_responses, _, _, _ = top_bottom_N_image_patches(model, nn.Conv2d,
+                                                image_dir, image_names, N=5)
+    for layer_responses in top_responses:
+        print(layer_responses[0])
 
 
 #######################################.#######################################
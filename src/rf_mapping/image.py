@@ -61,19 +61,24 @@ def preprocess_img_to_tensor(img, img_size=None):
     #     mean=[-0.01618503, -0.01468056, -0.01345447],
     #     std=[0.45679083, 0.44849625, 0.44975275],),
     # ])
-    transform = T.Compose([
-                T.ToTensor(),
-    ])
-    if len(img.shape) == 2:
-        img_temp = np.zeros((3, img.shape[0], img.shape[1]))
-        img_temp[0] = img
-        img_temp[1] = img
-        img_temp[2] = img
-        img = img_temp
+    # Upload the image first, then do the conversions on the device instead
+    # of making intermediate copies with numpy and T.ToTensor().
+    # uint8 images are uploaded as they are (fewer bytes to copy). Other
+    # types are cast to float32 on the host because some devices (e.g., MPS)
+    # do not support float64.
+    if img.dtype != np.uint8:
+        img = np.asarray(img, dtype=np.float32)
+    img_tensor = torch.as_tensor(img, device=c.DEVICE).float()
+    # Same scaling as T.ToTensor(), which only divides uint8 color images by
+    # 255 (grayscale images used to be promoted to float64 beforehand).
+    if img.dtype == np.uint8 and img.ndim == 3:
+        img_tensor = img_tensor / 255
+
+    if img_tensor.dim() == 2:
+        img_tensor = img_tensor.repeat(3, 1, 1)
     
-    if img.shape.index(3) == 0:
-        img = np.transpose(img, (1, 2, 0))
-    img_tensor = transform(img).type('torch.FloatTensor')
+    if img_tensor.shape.index(3) != 0:
+        img_tensor = img_tensor.permute(2, 0, 1).contiguous()
     
     img_tensor = torch.unsqueeze(img_tensor, dim=0)
 
@@ -81,7 +86,7 @@ def preprocess_img_to_tensor(img, img_size=None):
         resize = T.Resize(img_size)
         img_tensor = resize(img_tensor)
 
-    return img_tensor.to(c.DEVICE)
+    return img_tensor
 
 
 def preprocess_img_for_plot(img, norm=True):
@@ -208,6 +213,37 @@ if __name__ == "__main__":
     plt.show()
 
 
+#######################################.#######################################
+#                                                                             #
+#                                 PACK_IMAGES                                 #
+#                                                                             #
+###############################################################################
+def pack_images(img_dir, img_names, packed_path, dtype=np.float16):
+    """
+    Packs the .npy images into a single .npy file of the dimension
+    [num_images, 3, yn, xn] so that the dataset can later be streamed with
+    np.load(packed_path, mmap_mode='r') instead of loading the images one at
+    a time. Storing the images in float16 halves the number of bytes read.
+
+    Parameters
+    ----------
+    img_dir : str or path-like
+        The directory of the images.
+    img_names : list of strs or path-likes
+        The names of the image files. The images are packed in this order.
+    packed_path : str or path-like
+        The path of the resulting .npy file.
+    dtype : numpy.dtype
+        The data type of the packed images.
+    """
+    first_img = np.load(os.path.join(img_dir, img_names[0]))
+    packed = np.lib.format.open_memmap(packed_path, mode='w+', dtype=dtype,
+                                       shape=(len(img_names), *first_img.shape))
+    for img_i, img_name in enumerate(img_names):
+        packed[img_i] = np.load(os.path.join(img_dir, img_name))
+    packed.flush()
+
+
 #######################################.#######################################
 #                                                                             #
 #                              ONE_SIDED_ZERO_PAD                             #
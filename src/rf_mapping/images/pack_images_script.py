@@ -0,0 +1,24 @@
+"""
+Packs the imagenet dataset into a single float16 .npy file, which can then be
+memory-mapped by hook.top_bottom_N_image_patches(packed_path=...). Only needs
+to be run once.
+"""
+import os
+import sys
+
+sys.path.append('../../..')
+from src.rf_mapping.image import pack_images
+import src.rf_mapping.constants as c
+
+# Please specify some details here:
+num_images = 50000
+
+# Please double-check the directories:
+img_dir = c.IMG_DIR
+img_names = [f"{i}.npy" for i in range(num_images)]
+packed_path = os.path.join(img_dir, '..', 'packed_images.npy')
+
+###############################################################################
+
+pack_images(img_dir, img_names, packed_path)
+print(f"Packed {num_images} images at {packed_path}")
@@ -30,6 +30,30 @@ from src.rf_mapping.net import (get_truncated_model,
                                 get_conv_layer_indices,)
 
 
+#######################################.#######################################
+#                                                                             #
+#                                  IMPORT JIT                                #
+#                                                                             #
+#  Numba may not work with the lastest version of NumPy. In that case, a      #
+#  do-nothing decorator also named jit is used.                              #
+#                                                                             #
+###############################################################################
+try:
+    from numba import jit
+except:
+    warnings.warn("spatial.py cannot import Numba.")
+    def jit(func=None, **kwargs):
+        """
+        A do-nothing decorator in place of the actual njit in case that Python
+        cannot import Numba. Can be used either as @jit or @jit(...).
+        """
+        if func is None:
+            return jit
+        def wrapper(*args, **kwargs):
+            return func(*args, **kwargs)
+        return wrapper
+
+
 #######################################.#######################################
 #                                                                             #
 #                                    CLIP                                     #
@@ -42,6 +66,53 @@ def clip(x, x_min, x_max):
     return x
 
 
+#######################################.#######################################
+#                                                                             #
+#                             INDEX TRANSFORMS                                #
+#                                                                             #
+#  Project the index range [x_min, x_max] of one spatial dimension through a  #
+#  single layer, either forward (input -> output) or backward (output ->      #
+#  input). The _vec versions do the same for arrays of index ranges.          #
+#                                                                             #
+###############################################################################
+@jit(nopython=True, cache=True)
+def forward_transform(x_min, x_max, stride, kernel_size, padding, max_size):
+    x_min = (x_min + padding - kernel_size)//stride + 1
+    x_min = min(max(x_min, 0), max_size)
+    x_max = (x_max + padding)//stride
+    x_max = min(max(x_max, 0), max_size)
+    return x_min, x_max
+
+
+@jit(nopython=True, cache=True)
+def backward_transform(x_min, x_max, stride, kernel_size, padding, max_size):
+    x_min = (x_min * stride) - padding
+    x_min = min(max(x_min, 0), max_size)
+    x_max = (x_max * stride) + kernel_size - 1 - padding
+    x_max = min(max(x_max, 0), max_size)
+    return x_min, x_max
+
+
+@jit(nopython=True, cache=True)
+def forward_transform_vec(x_mins, x_maxs, stride, kernel_size, padding, max_size):
+    new_x_mins = np.empty_like(x_mins)
+    new_x_maxs = np.empty_like(x_maxs)
+    for i in range(len(x_mins)):
+        new_x_mins[i], new_x_maxs[i] = forward_transform(x_mins[i], x_maxs[i],
+                                        stride, kernel_size, padding, max_size)
+    return new_x_mins, new_x_maxs
+
+
+@jit(nopython=True, cache=True)
+def backward_transform_vec(x_mins, x_maxs, stride, kernel_size, padding, max_size):
+    new_x_mins = np.empty_like(x_mins)
+    new_x_maxs = np.empty_like(x_maxs)
+    for i in range(len(x_mins)):
+        new_x_mins[i], new_x_maxs[i] = backward_transform(x_mins[i], x_maxs[i],
+                                        stride, kernel_size, padding, max_size)
+    return new_x_mins, new_x_maxs
+
+
 #######################################.#######################################
 #                                                                             #
 #                               CALCULATE CENTER                              #
@@ -108,61 +179,64 @@ class SpatialIndexConverter(SizeInspector):
         self.graph_dict = make_graph(model)
         self.idx_to_node = {node.idx: name for name, node in self.graph_dict.items()}
 
-    def _forward_transform(self, x_min, x_max, stride, kernel_size, padding, max_size):
-        x_min = math.floor((x_min + padding - kernel_size)/stride + 1)
-        x_min = clip(x_min, 0, max_size)
-        x_max = math.floor((x_max + padding)/stride)
-        x_max = clip(x_max, 0, max_size)
-        return x_min, x_max
+        # Look up the transformation parameters of every layer once, instead
+        # of checking the layer types on every projection.
+        self.layer_transforms = self._build_layer_transforms()
 
-    def _backward_transform(self, x_min, x_max, stride, kernel_size, padding, max_size):
-        x_min = (x_min * stride) - padding
-        x_min = clip(x_min, 0, max_size)
-        x_max = (x_max * stride) + kernel_size - 1 - padding
-        x_max = clip(x_max, 0, max_size)
-        return x_min, x_max
+    def _build_layer_transforms(self):
+        """
+        Returns a list with one item per layer:
+            None: the layer does not need conversion.
+            ((stride_v, kernel_size_v, padding_v),
+             (stride_h, kernel_size_h, padding_h)): the parameters of the
+                transformation along the vertical and horizontal axes.
+            str: the layer is not supported. The string is the message of the
+                ValueError raised if a projection goes through the layer.
+        """
+        def to_pair(x):
+            # Sometimes the layer attributes do not come in the form of a tuple.
+            return (x[0], x[1]) if isinstance(x, tuple) else (x, x)
+
+        layer_transforms = []
+        for layer in self.layers:
+            if isinstance(layer, self.dont_need_conversion):
+                layer_transforms.append(None)
+            elif isinstance(layer, nn.Conv2d) and (layer.dilation != (1,1)):
+                layer_transforms.append("Dilated convolution is currently not supported by SpatialIndexConverter.")
+            elif isinstance(layer, nn.MaxPool2d) and (layer.dilation != 1):
+                layer_transforms.append("Dilated max pooling is currently not supported by SpatialIndexConverter.")
+            elif isinstance(layer, self.need_convsersion):
+                stride = to_pair(layer.stride)
+                kernel_size = to_pair(layer.kernel_size)
+                padding = to_pair(layer.padding)
+                layer_transforms.append(((stride[0], kernel_size[0], padding[0]),
+                                         (stride[1], kernel_size[1], padding[1])))
+            else:
+                layer_transforms.append(f"{type(layer)} is currently not supported by SpatialIndexConverter.")
+        return layer_transforms
 
     def _one_projection(self, layer_index, vx_min, hx_min, vx_max, hx_max, is_forward):
-        layer = self.layers[layer_index]
-
-        # Check the layer types to determine if a projection is necessary.
-        if isinstance(layer, self.dont_need_conversion):
+        layer_transform = self.layer_transforms[layer_index]
+        if layer_transform is None:
             return vx_min, hx_min, vx_max, hx_max
-        if isinstance(layer, nn.Conv2d) and (layer.dilation != (1,1)):
-            raise ValueError("Dilated convolution is currently not supported by SpatialIndexConverter.")
-        if isinstance(layer, nn.MaxPool2d) and (layer.dilation != 1):
-            raise ValueError("Dilated max pooling is currently not supported by SpatialIndexConverter.")
+        if isinstance(layer_transform, str):
+            raise ValueError(layer_transform)
+        v_params, h_params = layer_transform
 
         # Use a different max size and transformation function depending on the
         # projection direction.
+        # Arrays of indices (from convert_many()) use the _vec versions.
+        is_array = isinstance(vx_min, np.ndarray)
         if is_forward:
             _, v_max_size, h_max_size = self.output_sizes[layer_index]
-            transform = self._forward_transform
+            transform = forward_transform_vec if is_array else forward_transform
         else:
             _, v_max_size, h_max_size = self.input_sizes[layer_index]
-            transform = self._backward_transform
-
-        if isinstance(layer, self.need_convsersion):
-            try:
-                vx_min, vx_max = transform(vx_min, vx_max,
-                                        layer.stride[0], layer.kernel_size[0],
-                                        layer.padding[0], v_max_size)
-                hx_min, hx_max = transform(hx_min, hx_max,
-                                        layer.stride[1], layer.kernel_size[1],
-                                        layer.padding[1], h_max_size)
-                return vx_min, hx_min, vx_max, hx_max
-            except:
-                # Sometimes the layer attributes do not come in the form of
-                # a tuple. 
-                vx_min, vx_max = transform(vx_min, vx_max,
-                                        layer.stride, layer.kernel_size,
-                                        layer.padding, v_max_size)
-                hx_min, hx_max = transform(hx_min, hx_max,
-                                        layer.stride, layer.kernel_size,
-                                        layer.padding, h_max_size)
-                return vx_min, hx_min, vx_max, hx_max
-
-        raise ValueError(f"{type(layer)} is currently not supported by SpatialIndexConverter.")
+            transform = backward_transform_vec if is_array else backward_transform
+
+        vx_min, vx_max = transform(vx_min, vx_max, *v_params, v_max_size)
+        hx_min, hx_max = transform(hx_min, hx_max, *h_params, h_max_size)
+        return vx_min, hx_min, vx_max, hx_max
 
     def _process_index(self, index, start_layer_index):
         """
@@ -192,10 +266,13 @@ class SpatialIndexConverter(SizeInspector):
         in the box_list. Each box must be in (vx_min, hx_min, vx_max, hx_max)
         format.
         """
-        return min([box[0] for box in box_list]),\
-               min([box[1] for box in box_list]),\
-               max([box[2] for box in box_list]),\
-               max([box[3] for box in box_list])
+        if len(box_list) == 1:
+            return box_list[0]
+        # np.minimum/maximum also work when the boxes are arrays of indices.
+        return np.minimum.reduce([box[0] for box in box_list]),\
+               np.minimum.reduce([box[1] for box in box_list]),\
+               np.maximum.reduce([box[2] for box in box_list]),\
+               np.maximum.reduce([box[3] for box in box_list])
 
     def _forward_convert(self, vx_min, hx_min, vx_max, hx_max, start_layer_name,
                          end_layer_name):
@@ -301,17 +378,45 @@ class SpatialIndexConverter(SizeInspector):
         that can influence the output (of layer no.0) at (28,28).
         """
         vx, hx = self._process_index(index, start_layer_index)
-        vx_min, vx_max = vx, vx
-        hx_min, hx_max = hx, hx
-        # if is_forward:
-        #     index_gen = range(start_layer_index, end_layer_index + 1)
-        # else:
-        #     index_gen = range(start_layer_index, end_layer_index - 1, -1)
+        box = self._convert_box(vx, hx, start_layer_index, end_layer_index,
+                                is_forward)
+        return tuple(int(x) for x in box)
+        # Return format: (vx_min, hx_min, vx_max, hx_max)
 
-        # for layer_index in index_gen:
-        #     vx_min, hx_min, vx_max, hx_max = self._one_projection(layer_index, 
-        #                            vx_min, hx_min, vx_max, hx_max, is_forward)
+    def convert_many(self, indices, start_layer_index, end_layer_index, is_forward):
+        """
+        Same as convert(), but converts many spatial indices at once with
+        numpy arithmetic.
+
+        Parameters
+        ----------
+        indices : numpy.array
+            Either flattened indices with the dimension [num_indices], or
+            (vertical index, horizontal index) pairs with the dimension
+            [num_indices, 2].
+        See convert() for the other parameters.
 
+        Returns
+        -------
+        boxes : numpy.array
+            The boxes in (vx_min, hx_min, vx_max, hx_max) format, with the
+            dimension [num_indices, 4].
+        """
+        indices = np.asarray(indices)
+        if indices.ndim == 1:
+            _, output_height, output_width = self.output_sizes[start_layer_index]
+            vx, hx = np.unravel_index(indices, (output_height, output_width))
+        else:
+            vx, hx = indices[:, 0], indices[:, 1]
+        vx = np.ascontiguousarray(vx, dtype=np.int64)
+        hx = np.ascontiguousarray(hx, dtype=np.int64)
+        box = self._convert_box(vx, hx, start_layer_index, end_layer_index,
+                                is_forward)
+        return np.stack(np.broadcast_arrays(*box), axis=1)
+
+    def _convert_box(self, vx, hx, start_layer_index, end_layer_index, is_forward):
+        vx_min, vx_max = vx, vx
+        hx_min, hx_max = hx, hx
         start_layer_name = self.idx_to_node[start_layer_index]
         end_layer_name = self.idx_to_node[end_layer_index]
         if is_forward:
@@ -320,7 +425,6 @@ class SpatialIndexConverter(SizeInspector):
         else:
             return self._backward_convert(vx_min, hx_min, vx_max, hx_max, 
                                           start_layer_name, end_layer_name)
-        # Return format: (vx_min, hx_min, vx_max, hx_max)
 
 
 if __name__ == '__main__':
@@ -562,8 +666,48 @@ def _test_backward_conversion_inside_RF(model):
             break
 
 
+def _test_convert_many(model, num_indices=20):
+    """
+    Test function for SpatialIndexConverter.convert_many(). Checks that the
+    box of every index returned by convert_many() is the same as the one
+    returned by convert(), for both forward and backward projections.
+    """
+    image_size = (227, 227)
+    converter = SpatialIndexConverter(model, image_size)
+
+    # Forward projections from the image onto the outputs of every layer.
+    indices = np.stack((np.random.randint(0, image_size[0], num_indices),
+                        np.random.randint(0, image_size[1], num_indices)), axis=1)
+    for layer_i in range(len(converter.output_sizes)):
+        try:
+            boxes = converter.convert_many(indices, 0, layer_i, is_forward=True)
+        except:
+            print(f"The rest of the layers from layer no.{layer_i} are probably 1D.")
+            break
+        for i, index in enumerate(indices):
+            box = converter.convert(tuple(index), 0, layer_i, is_forward=True)
+            assert tuple(boxes[i]) == box, f"forward, layer no.{layer_i}, index {index}"
+
+    # Backward projections from the outputs of every layer onto the image.
+    for layer_i, output_size in enumerate(converter.output_sizes):
+        try:
+            _, max_height, max_width = output_size
+            indices = np.stack((np.random.randint(0, max_height, num_indices),
+                                np.random.randint(0, max_width, num_indices)), axis=1)
+            boxes = converter.convert_many(indices, layer_i, 0, is_forward=False)
+        except:
+            print(f"The rest of the layers from layer no.{layer_i} are probably 1D.")
+            break
+        for i, index in enumerate(indices):
+            box = converter.convert(tuple(index), layer_i, 0, is_forward=False)
+            assert tuple(boxes[i]) == box, f"backward, layer no.{layer_i}, index {index}"
+
+    print("convert_many() passed all tests.")
+
+
 if __name__ == '__main__':
     model = models.resnet18(pretrained=True)
+    _test_convert_many(model)
     # _test_backward_conversion_inside_RF(model)
     # _test_backward_conversion_outside_RF(model)
     # _test_forward_conversion() TODO: finish implementing this test
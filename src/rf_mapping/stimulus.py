@@ -34,11 +34,13 @@ try:
     from numba import jit
 except:
     warnings.warn("stimulus.py cannot import Numba.")
-    def jit(func):
+    def jit(func=None, **kwargs):
         """
         A do-nothing decorator in place of the actual njit in case that Python
-        cannot import Numba.
+        cannot import Numba. Can be used either as @jit or @jit(...).
         """
+        if func is None:
+            return jit
         def wrapper(*args, **kwargs):
             return func(*args, **kwargs)
         return wrapper
@@ -320,42 +322,45 @@ def record_script_log(txt_path, layer_name, batch_size, response_thres, num_stim
 #  that contains a fraction 'f' of the area of the map.                       #
 #                                                                             #
 ###############################################################################
+@jit(nopython=True, cache=True)
 def mapstat_comr_1(map,f):
     #
+    #  Compiled with Numba. The weighted sums are accumulated in one explicit
+    #  pass over the map instead of building temporary arrays.
     #
-    map = map.copy()
-    map = map - map.min()
-
-    xn = len(map)
-    list0 = np.sum(map,1)  # Sum along axis 1, to ultimately get COM on axis 0
-    list1 = np.sum(map,0)  # Sum along axis 0, to ultimately get COM on axis 1
-    total = np.sum(list0)  # Overall total weight of entire map
-    xvals = np.arange(xn)  # X-values (pix)
-    prod0 = xvals*list0
-    prod1 = xvals*list1
-    if (total > 0.0):
-        com0 = np.sum(prod0)/total
-        com1 = np.sum(prod1)/total
-    else:
-        com0 = com1 = -1
-
-    dist2 = []  # empty list to hold squared distances from COM
-    magn = []   # empty list to hold magnitude
-    for i in range(xn):
+    map = map - map.min()  # Makes a new array, so 'map' is not modified.
+
+    yn, xn = map.shape
+    total = 0.0  # Overall total weight of entire map
+    sum0 = 0.0   # Weighted sum of the indices along axis 0
+    sum1 = 0.0   # Weighted sum of the indices along axis 1
+    n = 0        # Number of non-zero positions in the map
+    for i in range(yn):
+        for j in range(xn):
+            total += map[i,j]
+            sum0 += i*map[i,j]
+            sum1 += j*map[i,j]
+            if (map[i,j] > 0.0):
+                n += 1
+
+    if not (total > 0.0):  # Also catches NaN maps.
+        return -1.0, -1.0, -1.0
+    com0 = sum0/total
+    com1 = sum1/total
+
+    dist2 = np.empty(n)  # squared distances from COM
+    magn = np.empty(n)   # magnitude
+    k = 0
+    for i in range(yn):
         di2 = (i-com0)*(i-com0)
         for j in range(xn):
-            dj2 = (j-com1)*(j-com1)
             if (map[i,j] > 0.0):
-                dist2.append(di2 + dj2)
-                magn.append(map[i,j])
+                dist2[k] = di2 + (j-com1)*(j-com1)
+                magn[k] = map[i,j]
+                k += 1
     
     isort = np.argsort(dist2)   # Get list of indices that sort list (least 1st)
     
-    if (com0 == -1):
-        return -1, -1, -1
-    
-    n = len(dist2)
-    
     # Go down the sorted list, adding up the magnitudes, until the fractional
     #  criterion is exceeded.  Compute the radius for the final point added.
     #
@@ -370,6 +375,46 @@ def mapstat_comr_1(map,f):
     return com0, com1, radius
 
 
+def _test_mapstat_comr_1():
+    """Compares mapstat_comr_1() with the original, uncompiled version."""
+    def old_mapstat_comr_1(map, f):
+        map = map - map.min()
+        xn = len(map)
+        total = np.sum(map)
+        if not (total > 0.0):
+            return -1, -1, -1
+        com0 = np.sum(np.arange(xn) * np.sum(map,1))/total
+        com1 = np.sum(np.arange(xn) * np.sum(map,0))/total
+        dist2 = []
+        magn = []
+        for i in range(xn):
+            for j in range(xn):
+                if (map[i,j] > 0.0):
+                    dist2.append((i-com0)**2 + (j-com1)**2)
+                    magn.append(map[i,j])
+        tot = 0.0
+        k = 0
+        for k in np.argsort(dist2):
+            tot += magn[k]
+            if (tot/total >= f):
+                break
+        return com0, com1, np.sqrt(dist2[k])
+
+    nan_map = np.random.rand(11, 11)
+    nan_map[3, 4] = np.nan
+    test_maps = {'nan' : nan_map,
+                 'constant' : np.ones((11, 11)),
+                 'normal' : np.random.rand(11, 11)}
+    for name, map in test_maps.items():
+        assert np.allclose(mapstat_comr_1(map, 0.5),
+                           old_mapstat_comr_1(map, 0.5)), name
+    print("mapstat_comr_1() passed all tests.")
+
+
+if __name__ == '__main__':
+    _test_mapstat_comr_1()
+
+
 #######################################.#######################################
 #                                                                             #
 #                                 MAKE_MAP_PDF                                #
@@ -8,21 +8,23 @@ Tony Fu, August 18th, 2022
 import os
 import sys
 import math
+import concurrent.futures
+from contextlib import ExitStack
 
 import numpy as np
 import torch.nn as nn
 from torchvision import models
 from tqdm import tqdm
-from scipy.stats import pearsonr
 from scipy.ndimage.filters import gaussian_filter
 import matplotlib.pyplot as plt
 from matplotlib.backends.backend_pdf import PdfPages
 from matplotlib.patches import Circle
 
 sys.path.append('../../..')
-from src.rf_mapping.gaussian_fit import (gaussian_fit,
+from src.rf_mapping.gaussian_fit import (gaussian_fit_batch,
+                                        plot_gaussian_fit,
                                         calc_f_explained_var,
-                                        theta_to_ori)
+                                        theta_to_ori_vec)
 from src.rf_mapping.gaussian_fit import GaussianFitParamFormat as ParamFormat
 from src.rf_mapping.hook import ConvUnitCounter
 from src.rf_mapping.spatial import get_rf_sizes
@@ -31,14 +33,12 @@ from src.rf_mapping.bar import mapstat_comr_1
 
 
 # Please specify some details here:
-model = models.alexnet(pretrained=True)
 model_name = 'alexnet'
-# model = models.vgg16(pretrained=True).to(c.DEVICE)
 # model_name = 'vgg16'
-# model = models.resnet18(pretrained=True).to(c.DEVICE)
 # model_name = "resnet18"
 image_shape = (227, 227)
 this_is_a_test_run = False
+make_pdf = True  # Plotting the fits of every unit takes most of the time.
 batch_size = 10
 conv_i_to_run = 4 # conv_i = 1 means Conv2
 rfmp_name = 'rfmp4c7o' 
@@ -61,45 +61,46 @@ result_dir = source_dir
 #     else: 
 #         raise KeyboardInterrupt("Interrupted by user")
 
-# Get info of conv layers.
-unit_counter = ConvUnitCounter(model)
-layer_indices, nums_units = unit_counter.count()
-_, rf_sizes = get_rf_sizes(model, image_shape, layer_type=nn.Conv2d)
-
-###############################################################################
-
 # Helper functions.
-def write_txt(f, layer_name, unit_i, raw_params, fxvar, map_size, num_bars):
+def write_txt(f, layer_name, all_raw_params, fxvars, map_size, num_bars):
+    """
+    Writes the Gaussian fit results of all units of the layer as a table, one
+    line per unit. all_raw_params has the dimension [num_units, NUM_PARAMS].
+    The post-processing is done on the whole array at once.
+    """
     # Unpack params
-    amp = raw_params[ParamFormat.A_IDX]
-    mu_x = raw_params[ParamFormat.MU_X_IDX]
-    mu_y = raw_params[ParamFormat.MU_Y_IDX]
-    sigma_1 = raw_params[ParamFormat.SIGMA_1_IDX]
-    sigma_2 = raw_params[ParamFormat.SIGMA_2_IDX]
-    theta = raw_params[ParamFormat.THETA_IDX]
-    offset = raw_params[ParamFormat.OFFSET_IDX]
+    amp = all_raw_params[:, ParamFormat.A_IDX]
+    mu_x = all_raw_params[:, ParamFormat.MU_X_IDX]
+    mu_y = all_raw_params[:, ParamFormat.MU_Y_IDX]
+    sigma_1 = all_raw_params[:, ParamFormat.SIGMA_1_IDX]
+    sigma_2 = all_raw_params[:, ParamFormat.SIGMA_2_IDX]
+    theta = all_raw_params[:, ParamFormat.THETA_IDX]
+    offset = all_raw_params[:, ParamFormat.OFFSET_IDX]
     
     # Some primitive processings:
     # (1) move original from top-left to map center.s
     mu_x = mu_x - (map_size/2)
     mu_y = mu_y - (map_size/2)
     # (2) take the abs value of sigma values.
-    sigma_1 = abs(sigma_1)
-    sigma_2 = abs(sigma_2)
+    sigma_1 = np.abs(sigma_1)
+    sigma_2 = np.abs(sigma_2)
     # (3) convert theta to orientation.
-    orientation = theta_to_ori(sigma_1, sigma_2, theta)
+    orientation = theta_to_ori_vec(sigma_1, sigma_2, theta)
 
-    f.write(f"{layer_name} {unit_i} ")
-    f.write(f"{mu_x:.2f} {mu_y:.2f} ")
-    f.write(f"{sigma_1:.2f} {sigma_2:.2f} ")
-    f.write(f"{orientation:.2f} ")
-    f.write(f"{amp:.3f} {offset:.3f} ")
-    f.write(f"{fxvar:.4f} ")  # the fraction of variance explained by params
-    f.write(f"{num_bars}\n")
+    num_units = len(all_raw_params)
+    table = np.column_stack((np.arange(num_units), mu_x, mu_y,
+                             sigma_1, sigma_2, orientation, amp, offset,
+                             fxvars,  # the fraction of variance explained by params
+                             np.broadcast_to(num_bars, (num_units,))))
+    np.savetxt(f, table,
+               fmt=f"{layer_name} %d %.2f %.2f %.2f %.2f %.2f %.3f %.3f %.4f %d")
 
 
 def load_maps(map_name, layer_name, num_stim, max_or_min):
-    """Loads the maps of the layer."""
+    """
+    Loads the maps of the layer. The maps are memory-mapped, so only the units
+    that are accessed are read from the disk.
+    """
     if map_name == 'gt':
         mapping_path = os.path.join(source_dir,
                                     '..',
@@ -108,7 +109,7 @@ def load_maps(map_name, layer_name, num_stim, max_or_min):
                                     model_name,
                                     'abs',
                                     f"{layer_name}_{max_or_min}.npy")
-        return np.load(mapping_path)  # [unit, yn, xn]
+        return np.load(mapping_path, mmap_mode='r')  # [unit, yn, xn]
     elif map_name == 'rfmp4a':
         mapping_path = os.path.join(source_dir,
                                     'rfmp4a',
@@ -116,7 +117,7 @@ def load_maps(map_name, layer_name, num_stim, max_or_min):
                                     layer_name,
                                     str(num_stim),
                                     f"{layer_name}_weighted_{max_or_min}_barmaps.npy")
-        return np.load(mapping_path)  # [unit, yn, xn]
+        return np.load(mapping_path, mmap_mode='r')  # [unit, yn, xn]
     elif map_name == 'rfmp4c7o':
         mapping_path = os.path.join(source_dir,
                                     'rfmp4c7o',
@@ -124,8 +125,12 @@ def load_maps(map_name, layer_name, num_stim, max_or_min):
                                     layer_name,
                                     str(num_stim),
                                     f"{layer_name}_weighted_{max_or_min}_barmaps.npy")
-        maps = np.load(mapping_path)  # [unit, 3, yn, xn]
-        return np.mean(maps, axis=1)
+        maps = np.load(mapping_path, mmap_mode='r')  # [unit, 3, yn, xn]
+        # Average the color channels a few units at a time so that the whole
+        # array is never read into memory at once.
+        chunk_size = 32
+        return np.concatenate([np.mean(maps[i:i+chunk_size], axis=1)
+                               for i in range(0, len(maps), chunk_size)])
     elif map_name == 'rfmp_sin1':
         mapping_path = os.path.join(source_dir,
                                     'rfmp_sin1',
@@ -133,7 +138,7 @@ def load_maps(map_name, layer_name, num_stim, max_or_min):
                                     layer_name,
                                     str(num_stim),
                                     f"{layer_name}_weighted_{max_or_min}_sinemaps.npy")
-        return np.load(mapping_path)  # [unit, yn, xn]
+        return np.load(mapping_path, mmap_mode='r')  # [unit, yn, xn]
     elif map_name == 'pasu':
         mapping_path = os.path.join(source_dir,
                                     'pasu',
@@ -141,11 +146,55 @@ def load_maps(map_name, layer_name, num_stim, max_or_min):
                                     layer_name,
                                     str(num_stim),
                                     f"{layer_name}_weighted_{max_or_min}_shapemaps.npy")
-        return np.load(mapping_path)  # [unit, yn, xn]
+        return np.load(mapping_path, mmap_mode='r')  # [unit, yn, xn]
     else:
         raise KeyError(f"{map_name} does not exist.")
 
 
+def load_bar_counts(stim_counts_path, layer_name):
+    """
+    Loads the numbers of bars used to make the max and min maps of each unit
+    in the layer. Each line of the file is made of:
+    [layer_name unit num_max_bars num_min_bars]
+    """
+    counts = np.loadtxt(stim_counts_path, dtype=str, ndmin=2)
+    counts = counts[counts[:, 0] == layer_name]
+    return counts[:, 2].astype(np.int64), counts[:, 3].astype(np.int64)
+
+
+def center_maps(maps):
+    """
+    Flattens the maps into the dimension [unit, yn * xn] and subtracts the
+    mean of each unit's map.
+    """
+    flat_maps = np.reshape(maps, (len(maps), -1)).astype(np.float64)
+    return flat_maps - flat_maps.mean(axis=1, keepdims=True)
+
+
+def batch_pearsonr(maps, centered_gt_maps):
+    """
+    Returns the Pearson correlation coefficients between maps[i] and the GT
+    map of every unit i, computed in one vectorized pass instead of calling
+    scipy.stats.pearsonr() once per unit. centered_gt_maps should be the
+    output of center_maps(gt_maps).
+    """
+    a = center_maps(maps)
+    b = centered_gt_maps[:len(a)]
+    return (a * b).sum(axis=1) / np.sqrt((a**2).sum(axis=1) * (b**2).sum(axis=1))
+
+
+def get_warm_start(params, sems):
+    """
+    Uses the Gaussian fits of the previous num_stim as the initial guesses of
+    the current ones. Units whose previous fit failed (see gaussian_fit())
+    fall back to the default guess.
+    """
+    if params is None:
+        return None
+    return [None if np.all(unit_sems == 999) else tuple(unit_params)
+            for unit_params, unit_sems in zip(params, sems)]
+
+
 def geo_mean(sd1, sd2):
     return np.sqrt(np.power(sd1, 2) + np.power(sd2, 2))
 
@@ -156,169 +205,204 @@ def get_hot_spot(map, rf_size):
 
 ###############################################################################
 
-layer_name = f"conv{conv_i_to_run + 1}"
-rf_size = rf_sizes[conv_i_to_run][0]
-
-
-for num_stim in num_stim_list:
-    # Load bar counts:
-    max_bar_counts = []
-    min_bar_counts = []
-    stim_counts_path = os.path.join(source_dir, rfmp_name, model_name, layer_name, str(num_stim), f"{model_name}_{rfmp_name}_weighted_counts.txt")
-    print(f"Saving results at {stim_counts_path}")
-    # with open(stim_counts_path) as count_f:
-    #     count_lines = count_f.readlines()
-    #     # Each line is made of: [layer_name unit num_max_bars num_min_bars]
-    #     for line in count_lines:
-    #         if line.split(' ')[0] == layer_name:
-    #             max_bar_counts.append(int(line.split(' ')[2]))
-    #             min_bar_counts.append(int(line.split(' ')[3]))
-
-    # Load bar maps:
-    gt_max_maps = load_maps('gt', layer_name, -1, 'max')
-    gt_min_maps = load_maps('gt', layer_name, -1, 'min')
-    max_maps = load_maps(rfmp_name, layer_name, num_stim, 'max')
-    min_maps = load_maps(rfmp_name, layer_name, num_stim, 'min')
+# The guard is needed because the Gaussian fits use multiprocessing.
+if __name__ == '__main__':
+    # The model is loaded here rather than at import time because the worker
+    # processes of the Gaussian fits import this script again.
+    model = getattr(models, model_name)(pretrained=True)
+
+    # Get info of conv layers.
+    unit_counter = ConvUnitCounter(model)
+    layer_indices, nums_units = unit_counter.count()
+    _, rf_sizes = get_rf_sizes(model, image_shape, layer_type=nn.Conv2d)
+
+    # All the Gaussian fits share one pool of processes.
+    with concurrent.futures.ProcessPoolExecutor() as executor:
+
+        layer_name = f"conv{conv_i_to_run + 1}"
+        rf_size = rf_sizes[conv_i_to_run][0]
+
+        # The GT maps do not depend on num_stim, so process them only once.
+        gt_max_maps = load_maps('gt', layer_name, -1, 'max')
+        gt_min_maps = load_maps('gt', layer_name, -1, 'min')
+        num_units = min(5, len(gt_max_maps)) if this_is_a_test_run else len(gt_max_maps)
+        centered_gt_max_maps = center_maps(gt_max_maps)
+        centered_gt_min_maps = center_maps(gt_min_maps)
+        gt_top_coms = [mapstat_comr_1(gt_max_maps[unit_i], 0.5) for unit_i in range(num_units)]
+        gt_bot_coms = [mapstat_comr_1(gt_min_maps[unit_i], 0.5) for unit_i in range(num_units)]
+        gt_top_hot_spots = [get_hot_spot(gt_max_maps[unit_i], rf_size) for unit_i in range(num_units)]
+        gt_bot_hot_spots = [get_hot_spot(gt_min_maps[unit_i], rf_size) for unit_i in range(num_units)]
+        if make_pdf:  # The GT fits are only plotted, not recorded.
+            gt_max_params, _ = gaussian_fit_batch(gt_max_maps[:num_units],
+                                                  executor=executor)
+            gt_min_params, _ = gaussian_fit_batch(gt_min_maps[:num_units],
+                                                  executor=executor)
+
+        max_params = max_sems = None
+        min_params = min_sems = None
+        for num_stim in num_stim_list:
+            # Load bar counts:
+            stim_counts_path = os.path.join(source_dir, rfmp_name, model_name, layer_name, str(num_stim), f"{model_name}_{rfmp_name}_weighted_counts.txt")
+            print(f"Saving results at {stim_counts_path}")
+            # max_bar_counts, min_bar_counts = load_bar_counts(stim_counts_path, layer_name)
+
+            # Load bar maps:
+            max_maps = load_maps(rfmp_name, layer_name, num_stim, 'max')
+            min_maps = load_maps(rfmp_name, layer_name, num_stim, 'min')
+
+            # Direct correlations of barmaps and GT maps of all units.
+            max_r_vals = batch_pearsonr(max_maps, centered_gt_max_maps)
+            min_r_vals = batch_pearsonr(min_maps, centered_gt_min_maps)
+
+            # Fit 2D Gaussians to the maps of all units in parallel. The maps of
+            # adjacent num_stim are similar, so the previous fits are good
+            # initial guesses.
+            max_params, max_sems = gaussian_fit_batch(max_maps[:num_units],
+                                            get_warm_start(max_params, max_sems),
+                                            executor=executor)
+            min_params, min_sems = gaussian_fit_batch(min_maps[:num_units],
+                                            get_warm_start(min_params, min_sems),
+                                            executor=executor)
     
-    top_txt_path = os.path.join(result_dir, rfmp_name, model_name, layer_name,
-                                str(num_stim), f"gaussian_fit_weighted_top.txt")
-    bot_txt_path = os.path.join(result_dir, rfmp_name, model_name, layer_name,
-                                str(num_stim), f"gaussian_fit_weighted_bot.txt")
-    corr_txt_path = os.path.join(result_dir, rfmp_name, model_name, layer_name,
-                                str(num_stim), f"map_correlations.txt")
-    com_txt_path = os.path.join(result_dir, rfmp_name, model_name, layer_name,
-                                str(num_stim), f"com.txt")
-    hot_spot_txt_path = os.path.join(result_dir, rfmp_name, model_name, layer_name,
-                                str(num_stim), f"hot_spot.txt")
+            top_txt_path = os.path.join(result_dir, rfmp_name, model_name, layer_name,
+                                        str(num_stim), f"gaussian_fit_weighted_top.txt")
+            bot_txt_path = os.path.join(result_dir, rfmp_name, model_name, layer_name,
+                                        str(num_stim), f"gaussian_fit_weighted_bot.txt")
+            corr_txt_path = os.path.join(result_dir, rfmp_name, model_name, layer_name,
+                                        str(num_stim), f"map_correlations.txt")
+            com_txt_path = os.path.join(result_dir, rfmp_name, model_name, layer_name,
+                                        str(num_stim), f"com.txt")
+            hot_spot_txt_path = os.path.join(result_dir, rfmp_name, model_name, layer_name,
+                                        str(num_stim), f"hot_spot.txt")
     
-    # Delete previous files
-    if os.path.exists(top_txt_path):
-        os.remove(top_txt_path)
-    if os.path.exists(bot_txt_path):
-        os.remove(bot_txt_path)
-    if os.path.exists(corr_txt_path):
-        os.remove(corr_txt_path)
-    if os.path.exists(com_txt_path):
-        os.remove(com_txt_path)
-    if os.path.exists(hot_spot_txt_path):
-        os.remove(hot_spot_txt_path)
-
-    pdf_path = os.path.join(result_dir, rfmp_name, model_name, layer_name, str(num_stim),
-                            f"{layer_name}_weighted_gaussian.pdf")
-    with PdfPages(pdf_path) as pdf:
-        for unit_i, (max_map, min_map) in enumerate(tqdm(zip(max_maps, min_maps))):
-            # Do only the first 5 unit during testing phase
-            if this_is_a_test_run and unit_i >= 5:
-                break
-
-            cy = cx = 0
-
-            # Direct correlation of barmap and GT map.
-            gt_max_map = gt_max_maps[unit_i]
-            gt_min_map = gt_min_maps[unit_i]
+            pdf_path = os.path.join(result_dir, rfmp_name, model_name, layer_name, str(num_stim),
+                                    f"{layer_name}_weighted_gaussian.pdf")
+            # Open the txt files once for all units. Opening them in 'w' mode also
+            # overwrites the results of previous runs.
+            with ExitStack() as stack:
+                if make_pdf:
+                    pdf = stack.enter_context(PdfPages(pdf_path))
+                top_f = stack.enter_context(open(top_txt_path, 'w'))
+                bot_f = stack.enter_context(open(bot_txt_path, 'w'))
+                corr_f = stack.enter_context(open(corr_txt_path, 'w'))
+                com_f = stack.enter_context(open(com_txt_path, 'w'))
+                hot_spot_f = stack.enter_context(open(hot_spot_txt_path, 'w'))
+
+                # Record the 2D Gaussian fits of all units.
+                max_fxvars = [calc_f_explained_var(max_maps[unit_i], max_params[unit_i])
+                              for unit_i in range(num_units)]
+                min_fxvars = [calc_f_explained_var(min_maps[unit_i], min_params[unit_i])
+                              for unit_i in range(num_units)]
+                # write_txt(top_f, layer_name, max_params, max_fxvars, rf_size, max_bar_counts[:num_units])
+                write_txt(top_f, layer_name, max_params, max_fxvars, rf_size, 0)
+                # write_txt(bot_f, layer_name, min_params, min_fxvars, rf_size, min_bar_counts[:num_units])
+                write_txt(bot_f, layer_name, min_params, min_fxvars, rf_size, 0)
+
+                for unit_i, (max_map, min_map) in enumerate(tqdm(zip(max_maps, min_maps))):
+                    # Do only the first 5 unit during testing phase
+                    if this_is_a_test_run and unit_i >= 5:
+                        break
+
+                    cy = cx = 0
+
+                    gt_max_map = gt_max_maps[unit_i]
+                    gt_min_map = gt_min_maps[unit_i]
             
-            max_r_val, _ = pearsonr(max_map.flatten(), gt_max_map.flatten())
-            min_r_val, _ = pearsonr(min_map.flatten(), gt_min_map.flatten())
-            
-            with open(corr_txt_path, 'a') as corr_f:
-                corr_f.write(f"{layer_name} {unit_i} {max_r_val:.4f} {min_r_val:.4f}\n")
-
-            # Compute the center of mass (COM)
-            top_y, top_x, top_rad = mapstat_comr_1(max_map, 0.5)
-            bot_y, bot_x, bot_rad = mapstat_comr_1(min_map, 0.5)
-            gt_top_y, gt_top_x, gt_top_rad = mapstat_comr_1(gt_max_map, 0.5)
-            gt_bot_y, gt_bot_x, gt_bot_rad = mapstat_comr_1(gt_min_map, 0.5)
+                    corr_f.write(f"{layer_name} {unit_i} {max_r_vals[unit_i]:.4f} {min_r_vals[unit_i]:.4f}\n")
+
+                    # Compute the center of mass (COM)
+                    top_y, top_x, top_rad = mapstat_comr_1(max_map, 0.5)
+                    bot_y, bot_x, bot_rad = mapstat_comr_1(min_map, 0.5)
+                    gt_top_y, gt_top_x, gt_top_rad = gt_top_coms[unit_i]
+                    gt_bot_y, gt_bot_x, gt_bot_rad = gt_bot_coms[unit_i]
             
-            # Compute error distances of COM
-            top_err_dist = math.sqrt((top_x - gt_top_x) ** 2 + (top_y - gt_top_y) ** 2)
-            bot_err_dist = math.sqrt((bot_x - gt_bot_x) ** 2 + (bot_y - gt_bot_y) ** 2)
+                    # Compute error distances of COM
+                    top_err_dist = math.sqrt((top_x - gt_top_x) ** 2 + (top_y - gt_top_y) ** 2)
+                    bot_err_dist = math.sqrt((bot_x - gt_bot_x) ** 2 + (bot_y - gt_bot_y) ** 2)
             
-            with open(com_txt_path, 'a') as com_f:
-                com_f.write(f"{layer_name} {unit_i} {top_err_dist:.4f} {bot_err_dist:.4f}\n")
-            top_com_mark = Circle((top_x + cx, top_y + cy), radius=1, color='green', label='com')
-            bot_com_mark = Circle((bot_x + cx, bot_y + cy), radius=1, color='green', label='com')
-            gt_top_com_mark = Circle((gt_top_x + cx, gt_top_y + cy), radius=1, color='green', label='com')
-            gt_bot_com_mark = Circle((gt_bot_x + cx, gt_bot_y + cy), radius=1, color='green', label='com')
+                    com_f.write(f"{layer_name} {unit_i} {top_err_dist:.4f} {bot_err_dist:.4f}\n")
+                    if make_pdf:
+                        top_com_mark = Circle((top_x + cx, top_y + cy), radius=1, color='green', label='com')
+                        bot_com_mark = Circle((bot_x + cx, bot_y + cy), radius=1, color='green', label='com')
+                        gt_top_com_mark = Circle((gt_top_x + cx, gt_top_y + cy), radius=1, color='green', label='com')
+                        gt_bot_com_mark = Circle((gt_bot_x + cx, gt_bot_y + cy), radius=1, color='green', label='com')
             
-            # Compute hot spot
-            top_y, top_x = get_hot_spot(max_map, rf_size)
-            bot_y, bot_x = get_hot_spot(min_map, rf_size)
-            gt_top_y, gt_top_x = get_hot_spot(gt_max_map, rf_size)
-            gt_bot_y, gt_bot_x = get_hot_spot(gt_min_map, rf_size)
+                    # Compute hot spot
+                    top_y, top_x = get_hot_spot(max_map, rf_size)
+                    bot_y, bot_x = get_hot_spot(min_map, rf_size)
+                    gt_top_y, gt_top_x = gt_top_hot_spots[unit_i]
+                    gt_bot_y, gt_bot_x = gt_bot_hot_spots[unit_i]
             
-            # Compute error distances of hot spot
-            top_err_dist = math.sqrt((top_x - gt_top_x) ** 2 + (top_y - gt_top_y) ** 2)
-            bot_err_dist = math.sqrt((bot_x - gt_bot_x) ** 2 + (bot_y - gt_bot_y) ** 2)
+                    # Compute error distances of hot spot
+                    top_err_dist = math.sqrt((top_x - gt_top_x) ** 2 + (top_y - gt_top_y) ** 2)
+                    bot_err_dist = math.sqrt((bot_x - gt_bot_x) ** 2 + (bot_y - gt_bot_y) ** 2)
             
-            with open(hot_spot_txt_path, 'a') as hot_spot_f:
-                hot_spot_f.write(f"{layer_name} {unit_i} {top_err_dist:.4f} {bot_err_dist:.4f}\n")
-            top_hot_spot_mark = Circle((top_x + cx, top_y + cy), radius=1, color='cyan', label='hotspot')
-            bot_hot_spot_mark = Circle((bot_x + cx, bot_y + cy), radius=1, color='cyan', label='hotspot')
-            gt_top_hot_spot_mark = Circle((gt_top_x + cx, gt_top_y + cy), radius=1, color='cyan', label='hotspot')
-            gt_bot_hot_spot_mark = Circle((gt_bot_x + cx, gt_bot_y + cy), radius=1, color='cyan', label='hotspot')
+                    hot_spot_f.write(f"{layer_name} {unit_i} {top_err_dist:.4f} {bot_err_dist:.4f}\n")
+
+                    if not make_pdf:
+                        continue
+
+                    top_hot_spot_mark = Circle((top_x + cx, top_y + cy), radius=1, color='cyan', label='hotspot')
+                    bot_hot_spot_mark = Circle((bot_x + cx, bot_y + cy), radius=1, color='cyan', label='hotspot')
+                    gt_top_hot_spot_mark = Circle((gt_top_x + cx, gt_top_y + cy), radius=1, color='cyan', label='hotspot')
+                    gt_bot_hot_spot_mark = Circle((gt_bot_x + cx, gt_bot_y + cy), radius=1, color='cyan', label='hotspot')
             
-            # Fit 2D Gaussian, and plot them.
-            plt.figure(figsize=(20, 20))
-            plt.suptitle(f"Elliptical Gaussian fit ({layer_name} no.{unit_i})", fontsize=20)
+                    # Plot the 2D Gaussian fits.
+                    plt.figure(figsize=(20, 20))
+                    plt.suptitle(f"Elliptical Gaussian fit ({layer_name} no.{unit_i})", fontsize=20)
             
-            plt.subplot(2, 2, 1)
-            params, sems = gaussian_fit(gt_max_map, plot=True, show=False, cmap=plt.cm.gray)
-            fxvar = calc_f_explained_var(gt_max_map, params)
-            radius = geo_mean(params[ParamFormat.SIGMA_1_IDX], params[ParamFormat.SIGMA_2_IDX])
-            plt.title(f"GT max {radius:.2f}", fontsize=18)
-            gt_top_gaussian_mark = Circle((params[ParamFormat.MU_X_IDX] + cx, params[ParamFormat.MU_Y_IDX] + cy),
-                                        radius=1, color='red', label='gaussian')
-            ax = plt.gca()
-            for p in [gt_top_gaussian_mark, gt_top_com_mark, gt_top_hot_spot_mark]:
-                ax.add_patch(p)
-            plt.legend()
-
-
-            plt.subplot(2, 2, 2)
-            params, sems = gaussian_fit(max_map, plot=True, show=False, cmap=plt.cm.gray)
-            fxvar = calc_f_explained_var(max_map, params)
-            with open(top_txt_path, 'a') as top_f:
-                # write_txt(top_f, layer_name, unit_i, params, fxvar, rf_size, max_bar_counts[unit_i])
-                write_txt(top_f, layer_name, unit_i, params, fxvar, rf_size, 0)
-            radius = geo_mean(params[ParamFormat.SIGMA_1_IDX], params[ParamFormat.SIGMA_2_IDX])
-            plt.title(f"{rfmp_name} max {radius:.2f}", fontsize=18)
-            top_gaussian_mark = Circle((params[ParamFormat.MU_X_IDX] + cx, params[ParamFormat.MU_Y_IDX] + cy),
-                                        radius=1, color='red', label='gaussian')
-            ax = plt.gca()
-            for p in [top_gaussian_mark, top_com_mark, top_hot_spot_mark]:
-                ax.add_patch(p)
-            plt.legend()
+                    plt.subplot(2, 2, 1)
+                    params = gt_max_params[unit_i]
+                    plot_gaussian_fit(gt_max_map, params, cmap=plt.cm.gray)
+                    radius = geo_mean(params[ParamFormat.SIGMA_1_IDX], params[ParamFormat.SIGMA_2_IDX])
+                    plt.title(f"GT max {radius:.2f}", fontsize=18)
+                    gt_top_gaussian_mark = Circle((params[ParamFormat.MU_X_IDX] + cx, params[ParamFormat.MU_Y_IDX] + cy),
+                                                radius=1, color='red', label='gaussian')
+                    ax = plt.gca()
+                    for p in [gt_top_gaussian_mark, gt_top_com_mark, gt_top_hot_spot_mark]:
+                        ax.add_patch(p)
+                    plt.legend()
+
+
+                    plt.subplot(2, 2, 2)
+                    params = max_params[unit_i]
+                    plot_gaussian_fit(max_map, params, cmap=plt.cm.gray)
+                    radius = geo_mean(params[ParamFormat.SIGMA_1_IDX], params[ParamFormat.SIGMA_2_IDX])
+                    plt.title(f"{rfmp_name} max {radius:.2f}", fontsize=18)
+                    top_gaussian_mark = Circle((params[ParamFormat.MU_X_IDX] + cx, params[ParamFormat.MU_Y_IDX] + cy),
+                                                radius=1, color='red', label='gaussian')
+                    ax = plt.gca()
+                    for p in [top_gaussian_mark, top_com_mark, top_hot_spot_mark]:
+                        ax.add_patch(p)
+                    plt.legend()
             
 
-            plt.subplot(2, 2, 3)
-            params, sems = gaussian_fit(gt_min_map, plot=True, show=False, cmap=plt.cm.gray)
-            fxvar = calc_f_explained_var(gt_min_map, params)
-            radius = geo_mean(params[ParamFormat.SIGMA_1_IDX], params[ParamFormat.SIGMA_2_IDX])
-            plt.title(f"GT min {radius:.2f}", fontsize=18)
-            gt_bot_gaussian_mark = Circle((params[ParamFormat.MU_X_IDX] + cx, params[ParamFormat.MU_Y_IDX] + cy),
-                                        radius=1, color='red', label='gaussian')
-            ax = plt.gca()
-            for p in [gt_bot_gaussian_mark, gt_bot_com_mark, gt_bot_hot_spot_mark]:
-                ax.add_patch(p)
-            plt.legend()
+                    plt.subplot(2, 2, 3)
+                    params = gt_min_params[unit_i]
+                    plot_gaussian_fit(gt_min_map, params, cmap=plt.cm.gray)
+                    radius = geo_mean(params[ParamFormat.SIGMA_1_IDX], params[ParamFormat.SIGMA_2_IDX])
+                    plt.title(f"GT min {radius:.2f}", fontsize=18)
+                    gt_bot_gaussian_mark = Circle((params[ParamFormat.MU_X_IDX] + cx, params[ParamFormat.MU_Y_IDX] + cy),
+                                                radius=1, color='red', label='gaussian')
+                    ax = plt.gca()
+                    for p in [gt_bot_gaussian_mark, gt_bot_com_mark, gt_bot_hot_spot_mark]:
+                        ax.add_patch(p)
+                    plt.legend()
             
 
-            plt.subplot(2, 2, 4)
-            params, sems = gaussian_fit(min_map, plot=True, show=False, cmap=plt.cm.gray)
-            fxvar = calc_f_explained_var(min_map, params)
-            with open(bot_txt_path, 'a') as bot_f:
-                # write_txt(bot_f, layer_name, unit_i, params, fxvar, rf_size, min_bar_counts[unit_i])
-                write_txt(bot_f, layer_name, unit_i, params, fxvar, rf_size, 0)
-            radius = geo_mean(params[ParamFormat.SIGMA_1_IDX], params[ParamFormat.SIGMA_2_IDX])
-            plt.title(f"{rfmp_name} min {radius:.2f}", fontsize=18)
-            bot_gaussian_mark = Circle((params[ParamFormat.MU_X_IDX] + cx, params[ParamFormat.MU_Y_IDX] + cy),
-                                        radius=1, color='red', label='gaussian')
-            ax = plt.gca()
-            for p in [bot_gaussian_mark, bot_com_mark, bot_hot_spot_mark]:
-                ax.add_patch(p)
-            plt.legend()
-
-
-            pdf.savefig()
-            if this_is_a_test_run: plt.show()
-            plt.close()
+                    plt.subplot(2, 2, 4)
+                    params = min_params[unit_i]
+                    plot_gaussian_fit(min_map, params, cmap=plt.cm.gray)
+                    radius = geo_mean(params[ParamFormat.SIGMA_1_IDX], params[ParamFormat.SIGMA_2_IDX])
+                    plt.title(f"{rfmp_name} min {radius:.2f}", fontsize=18)
+                    bot_gaussian_mark = Circle((params[ParamFormat.MU_X_IDX] + cx, params[ParamFormat.MU_Y_IDX] + cy),
+                                                radius=1, color='red', label='gaussian')
+                    ax = plt.gca()
+                    for p in [bot_gaussian_mark, bot_com_mark, bot_hot_spot_mark]:
+                        ax.add_patch(p)
+                    plt.legend()
+
+
+                    pdf.savefig()
+                    if this_is_a_test_run: plt.show()
+                    plt.close()